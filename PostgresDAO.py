@@ -1,4 +1,6 @@
+import io
 import psycopg2
+from psycopg2.extras import execute_values
 import random
 if __name__ == "__main__": #for formatieve opdracht 2c
     import MongodbDAO
@@ -130,23 +132,98 @@ class PostgreSQLdb:
         self._close_connection()
         return output
 
-    def many_update_queries(self, query: str, data_list: list[tuple]):
+    def stream_query(self, query: str, parameters: tuple = None, itersize: int = 10000):
+        """Executes a SELECT query with a server-side (named) cursor, and yields the result row by row.
+        The rows are fetched from the DB in batches of itersize rows,
+        so the full result never has to be in memory at once (unlike query(expect_return=True)).
+        The connection is closed once every row has been yielded.
+
+        Args:
+            query:
+                The SQL query to execute.
+                May contain '%s' in place of parameters to let psycopg2 automatically format them.
+                The values to replace the %s's with can be passed with the parameters parameter.
+            parameters: tuple containing parameters to replace the %s's in the query with.
+            itersize: the amount of rows to fetch from the DB at once.
+
+        Yields:
+            a tuple for every row in the query result."""
+        #a local connection and cursor, so other queries on this db can't replace them between yields
+        connection = psycopg2.connect(
+            host = self.host,
+            database = self.database,
+            user = self.user,
+            password = self.password,
+            port = self.port
+        )
+        try:
+            with connection, connection.cursor(name="stream_query") as cursor:
+                cursor.itersize = itersize
+                cursor.execute(query, parameters)
+                yield from cursor
+        finally:
+            connection.close()
+
+    def many_update_queries(self, query: str, data_list: list[tuple], page_size: int = 1000):
         """Execute a single query that updates the DB with many different values without constantly opening/closing cursors/connections.
+        Uses psycopg2.extras.execute_values() to send the rows in pages of page_size rows per query,
+        instead of a query (and a round-trip to the DB) for every row.
 
         Args:
             query:
                 The SQL query to execute with every dataset in data_list.
-                Must contain '%s' in place of parameters to let psycopg2 automatically format them.
-                The values to replace the %s's with must be passed with the parameters parameter.
+                Must contain a single '%s' in place of all the value rows (for instance 'INSERT INTO t (a, b) VALUES %s;')
+                to let psycopg2 automatically format them.
             data_list:
-                list containing a tuple for every query that has to be excecuted."""
+                list containing a tuple for every row that has to be inserted.
+            page_size: the maximum amount of rows to send to the DB per query."""
         self._connect()
         self._summon_cursor()
-        self.cursor.executemany(query, data_list)
+        execute_values(self.cursor, query, data_list, page_size=page_size)
         self._commit_changes()
         self._close_cursor()
         self._close_connection()
 
+    @staticmethod
+    def _format_copy_value(value) -> str:
+        """Formats a single value for copy_rows().
+        Every value gets quoted, so an empty string stays an empty string,
+        while None becomes an unquoted \\N, which is the only thing COPY reads as NULL.
+
+        Args:
+            value: the value to format.
+
+        Returns:
+            the value as CSV field."""
+        if value is None:
+            return "\\N"
+        return '"' + str(value).replace('"', '""') + '"'
+
+    def copy_rows(self, table_name: str, column_names: list[str], data_list: list[tuple], setup_queries: list[str] = None, finish_queries: list[str] = None):
+        """Bulk-load many rows into a table with a single COPY FROM STDIN,
+        avoiding the per-row parsing/planning of INSERT queries.
+        Best suited for tables that are filled from scratch.
+
+        Args:
+            table_name: the name of the table to load the rows into.
+            column_names: list containing the names of the columns to fill, in the same order as the values in every row.
+            data_list:
+                list containing a tuple for every row that has to be inserted.
+            setup_queries: list of queries to execute before the COPY, in the same transaction (for instance creating the table).
+            finish_queries: list of queries to execute after the COPY, in the same transaction (for instance adding foreign keys)."""
+        buffer = io.StringIO()
+        buffer.writelines(",".join(map(self._format_copy_value, row)) + "\n" for row in data_list)
+        buffer.seek(0)
+        self._connect()
+        self._summon_cursor()
+        for query in setup_queries or []:
+            self._bare_query(query)
+        self.cursor.copy_expert(f"COPY {table_name} ({', '.join(column_names)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+        for query in finish_queries or []:
+            self._bare_query(query)
+        self._commit_changes()
+        self._close_cursor()
+        self._close_connection()
 
     def regenerate_db(self, ddl_source: str):
         """Empties all knows tables in the DB, and reconstructs everything according to the DDL(SQL) file provided.
@@ -44,7 +44,8 @@ def retrieve_from_dict_depths_recursively(input: dict, keys: list):
 
 
 def construct_insert_query(table_name: str, var_names: list[str]) -> str:
-    """Constructs an SQL insert query, formatted to use %s in place of actual values to allow PsycoPG2 to properly format them.
+    """Constructs an SQL insert query, formatted to use a single %s in place of all the value rows,
+    to allow psycopg2.extras.execute_values() to insert many rows per query.
 
     Args:
         table_name: the name of the table to insert to insert into.
@@ -53,12 +54,7 @@ def construct_insert_query(table_name: str, var_names: list[str]) -> str:
     Returns:
         A properly formatted SQL query as string.
     """
-    q = f"INSERT INTO {table_name} ("
-    q += var_names[0]
-    for var in var_names[1:]:
-        q += ", " + var
-    q += f") VALUES (%s{(len(var_names) - 1) * ', %s'});"
-    return q
+    return f"INSERT INTO {table_name} ({', '.join(var_names)}) VALUES %s;"
 
 
 def simple_mongo_to_sql(mongo_collection_name: str, #TODO: write docstring when computer is not dying
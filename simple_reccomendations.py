@@ -1,57 +1,50 @@
 import PostgresDAO
+import bisect
+import contextlib
+import functools
+import gc
+import glob
+import hashlib
+import itertools
+import multiprocessing
+import os
+import pickle
 import random
+import tempfile
 
 
-def construct_insert_query(table_name: str, var_names: list[str]) -> str: #TODO: Don't copy/paste from mongo_to_pg
-    """Constructs an SQL insert query, formatted to use %s in place of actual values to allow PsycoPG2 to properly format them.
-
-    Args:
-        table_name: the name of the table to insert to insert into.
-        var_names: a list containing all the attributes to insert.
-
-    Returns:
-        A properly formatted SQL query as string.
-    """
-    q = f"INSERT INTO {table_name} ("
-    q += var_names[0]
-    for var in var_names[1:]:
-        q += ", " + var
-    q += f") VALUES (%s{(len(var_names) - 1) * ', %s'});"
-    return q
-
-
-def create_rcmd_table(db: PostgresDAO.PostgreSQLdb, table_name: str, unique_attributes: list[tuple[str, str]]):
-    """Create a table in a PostgreSQL database for the purpose of filling it with reccomendations.
+def create_rcmd_table(db: PostgresDAO.PostgreSQLdb, table_name: str, unique_attributes: list[tuple[str, str]], dataset: list[tuple]):
+    """Create a table in a PostgreSQL database for the purpose of filling it with reccomendations, and fill it.
     Create it according to this format:
     any number of columns that are primary keys to store the unique attributes by.
     4 foreign key columns to fill with product_ids to recommend in association with the unique attributes.
 
+    Dropping, creating and filling the table all happen in a single transaction.
+    The foreign keys are only added after the table is filled, so PostgreSQL checks them all at once instead of row by row.
+
     Args:
         db: The PostgreSQL db to put the table in.
         table_name: the name the newly created table should have.
         unique_attributes: Any amount of tuples, 1 for each unique attribute to recommend by. Each must contain:
             0: The name the attribute should get in the newly created table.
             1: The PostgreSQL datatype (preferebly capitalized) the new attribute should have.
+        dataset: list containing a tuple for every row to fill the table with, as gained by content_filter_result_to_useful_SQL_dataset().
 
     The 4 recommendation columns will be called (rcmd_1 ... rcmd_4)."""
-    db.query(f"DROP TABLE IF EXISTS {table_name};", commit_changes=True)
-    query = f"CREATE TABLE {table_name}(\n"
-    for attribute_name, attribute_type in unique_attributes:
-        query += f"{attribute_name} {attribute_type},\n"
-    query += f"""rcmd_1 VARCHAR,
-rcmd_2 VARCHAR,
-rcmd_3 VARCHAR,
-rcmd_4 VARCHAR,
-PRIMARY KEY({unique_attributes[0][0]}"""
-    for atttribute_name, attribute_type in unique_attributes[1:]:
-        query += f", {atttribute_name}"
-    query +="""),
-FOREIGN KEY(rcmd_1) REFERENCES Products(id),
-FOREIGN KEY(rcmd_2) REFERENCES Products(id),
-FOREIGN KEY(rcmd_3) REFERENCES Products(id),
-FOREIGN KEY(rcmd_4) REFERENCES Products(id)
+    rcmd_columns = ["rcmd_1", "rcmd_2", "rcmd_3", "rcmd_4"]
+    column_names = [attribute_name for attribute_name, _ in unique_attributes] + rcmd_columns
+    #catch an empty or malformed dataset here, instead of silently loading nothing
+    assert dataset, "No recommendations were generated"
+    assert len(dataset[0]) == len(column_names), f"Expected rows of {len(column_names)} values, got {dataset[0]}"
+    column_definitions = "".join(f"{attribute_name} {attribute_type},\n" for attribute_name, attribute_type in unique_attributes)
+    column_definitions += "".join(f"{column} VARCHAR,\n" for column in rcmd_columns)
+    primary_key = ", ".join(attribute_name for attribute_name, _ in unique_attributes)
+    create_query = f"""CREATE TABLE {table_name}(
+{column_definitions}PRIMARY KEY({primary_key})
 );"""
-    db.query(query, commit_changes=True)
+    foreign_key_query = f"ALTER TABLE {table_name} " + ", ".join(f"ADD FOREIGN KEY({column}) REFERENCES Products(id)" for column in rcmd_columns) + ";"
+    db.copy_rows(table_name, column_names, dataset,
+                 setup_queries=[f"DROP TABLE IF EXISTS {table_name};", create_query], finish_queries=[foreign_key_query])
 
 
 def group_data_by_unique_identifiers(dataset: list[tuple], index_list: list[int]) -> dict:
@@ -91,79 +84,287 @@ def group_data_by_unique_identifiers(dataset: list[tuple], index_list: list[int]
     return unique_identifiers
 
 
-def content_filter_recommendations_from_grouped_data(data: dict or list, original_dataset: list[tuple], current_level: int = 0, recommendation_amount: int = 4) -> tuple[list, list]:
-    """Recursively generate a given amount of recommendations from data as formatted by group_data_by_unique_identifiers().
+def cached_group_query_result(db: PostgresDAO.PostgreSQLdb, query: str, fingerprint_query: str, index_list: list[int], cache_directory: str = "cache") -> tuple[list, dict]:
+    """Run a SELECT query and group its result with group_data_by_unique_identifiers(),
+    or load it from a pickle on disk if the data hasn't changed since the last run.
+    The rows are streamed straight into the grouping, so the query result is never held in memory a second time.
+
+    Args:
+        db: The PostgreSQL db to run the queries in.
+        query: the SELECT query to group the result of.
+        fingerprint_query:
+            a query that returns a single row, which changes whenever the result of query would change.
+            (for instance the row count together with a sum of the hashes of every row)
+            This runs on every call, so it should cost no more than a single scan:
+            avoid ORDER BY and string_agg() over the whole table, which sort it and build one value the size of the table.
+        index_list: list of the index of every attribute in the SELECT query that the data should be grouped by.
+        cache_directory: the directory to store the pickles in.
+
+    Returns:
+        tuple containing:
+            0: list of the first attribute of every row in the query result (for instance the product IDs).
+            1: the grouped query result."""
+    fingerprint = db.query(fingerprint_query, expect_return=True)[0]
+    query_key = hashlib.md5(f"{query}|{index_list}".encode()).hexdigest()
+    fingerprint_key = hashlib.md5(str(fingerprint).encode()).hexdigest()
+    cache_path = os.path.join(cache_directory, f"grouped_{query_key}_{fingerprint_key}.pkl")
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as file:
+            return pickle.load(file)
+    grouped = group_data_by_unique_identifiers(db.stream_query(query), index_list)
+    result = [entry[0] for _, entries in flatten_grouped_data(grouped) for entry in entries], grouped
+    os.makedirs(cache_directory, exist_ok=True)
+    #dump to a temporary file first, so an interrupted run can't leave a truncated pickle at cache_path
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=cache_directory, suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, "wb") as file:
+            pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, cache_path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+    for old_cache_path in glob.glob(os.path.join(cache_directory, f"grouped_{query_key}_*.pkl")): #pickles of outdated data for this query
+        if os.path.abspath(old_cache_path) != os.path.abspath(cache_path):
+            os.remove(old_cache_path)
+    return result
+
+
+def flatten_grouped_data(data: dict or list) -> list[tuple[tuple, list[tuple]]]:
+    """Flatten data as formatted by group_data_by_unique_identifiers() into a list of its attribute permutations,
+    without recursion.
+
+    Args:
+        data: the dict_in_dict stucture as provided by group_data_by_unique_identifiers()
+
+    Returns:
+        list containing a tuple for every attribute permutation, in the same order as in data. Each contains:
+            0: tuple containing the keys of the permutation, from the top level dict going down.
+            1: the list of products in that permutation."""
+    return _flatten_grouped_data_with_node_ends(data)[0]
+
+
+def _flatten_grouped_data_with_node_ends(data: dict or list) -> tuple[list[tuple[tuple, list[tuple]]], list[list[int]]]:
+    """Does the same as flatten_grouped_data(), and also returns where every dict in data ends within the flattened list.
+    Walks data one level at a time, so every dict only gets checked for its type once per level.
+
+    Args:
+        data: the dict_in_dict stucture as provided by group_data_by_unique_identifiers()
+
+    Returns:
+        tuple containing:
+            0: the same as flatten_grouped_data()
+            1: list containing a list for every level of dicts, starting at the top level dict.
+                Every nested list contains for each dict on that level (in order) the index in the flattened list right after its last permutation."""
+    if not isinstance(data, dict):
+        return [((), data)], []
+    level_keys, level_nodes, child_counts = [()], [data], []
+    while True:
+        child_counts.append([len(node) for node in level_nodes])
+        #every value on a level is of the same type, so checking one tells wether they're all dicts or all product lists
+        if not isinstance(next(iter(level_nodes[0].values()), None), dict):
+            break
+        level_keys = [(*keys, k) for keys, node in zip(level_keys, level_nodes) for k in node]
+        level_nodes = [child for node in level_nodes for child in node.values()]
+    flattened = [((*keys, k), products) for keys, node in zip(level_keys, level_nodes) for k, products in node.items()]
+    #a dict ends where its last child ends, so work up from the deepest level of dicts
+    node_ends = [list(itertools.accumulate(child_counts[-1]))]
+    for counts in reversed(child_counts[:-1]):
+        child_ends = node_ends[0]
+        node_ends.insert(0, [child_ends[child_count - 1] for child_count in itertools.accumulate(counts)])
+    return flattened, node_ends
+
+
+@contextlib.contextmanager
+def _garbage_collection_paused():
+    """Context manager that pauses Python's cyclic garbage collector, and restores it afterwards.
+    Building many small containers triggers a collection every few hundred allocations,
+    and each of those may walk every product tuple that is alive at the time."""
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+
+def _finish_incomplete_recommendations(dataset: list[tuple[tuple, list]], node_incomplete_indexes: list[int], node_product_lists: list[list[tuple]],
+                                       product_ids: list, top_level: bool, recommendation_amount: int) -> list[int]:
+    """Try to finish the incomplete recommendations of a single node in the dict_in_dict structure (in place).
+    Used by content_filter_recommendations_from_grouped_data().
+
+    Args:
+        dataset: list containing the recommendations so far, as returned by content_filter_recommendations_from_grouped_data().
+        node_incomplete_indexes: the indexes in dataset of the incomplete recommendations within this node.
+        node_product_lists: the product lists of every attribute permutation within this node.
+        product_ids: list containing the ID of every product, to fetch random products from.
+        top_level: bool for wether the node is the top level dict, which fills from product_ids if all else fails.
+        recommendation_amount: the amount of products that should be recommended per attribute permutation.
+
+    Returns:
+        list containing the indexes that are still incomplete, to be passed to the level above."""
+    filler_amount = sum(recommendation_amount - len(dataset[index][1]) for index in node_incomplete_indexes)
+    if len(node_product_lists) - len(node_incomplete_indexes) >= recommendation_amount: #finish them with products from the rest of the node
+        #only the permutations that were complete on their own, so the pool never holds an incomplete permutation's own products.
+        #a node only gets here if it contains at least recommendation_amount of those.
+        filler_pool = list(itertools.chain.from_iterable(products for products in node_product_lists if len(products) >= recommendation_amount))
+        #draw all filler at once (uniform over products), and only take the IDs of the drawn ones
+        random_ids = iter([product[0] for product in random.choices(filler_pool, k=filler_amount)])
+        draw_id = lambda: random.choice(filler_pool)[0]
+    elif top_level: #Random additions from all products
+        filler_pool = product_ids
+        random_ids = iter(random.choices(product_ids, k=filler_amount))
+        draw_id = lambda: random.choice(product_ids)
+    else: #leave them for the level above
+        return node_incomplete_indexes
+    target_length = min(recommendation_amount, len(filler_pool))
+    for index in node_incomplete_indexes:
+        recommended_ids = dataset[index][1]
+        while len(recommended_ids) < target_length:
+            product_id = next(random_ids, None)
+            if product_id is None: #only draw again for the ones that were already in the recommendation
+                product_id = draw_id()
+            if product_id not in recommended_ids:
+                recommended_ids.append(product_id)
+    return []
+
+
+def content_filter_recommendations_from_grouped_data(data: dict or list, product_ids: list, current_level: int = 0, recommendation_amount: int = 4) -> tuple[list, list]:
+    """Generate a given amount of recommendations from data as formatted by group_data_by_unique_identifiers().
     Refer to that function's documentation for more information of datastructure.
     When an attribute permutation has enough products to recommend (4 by default), recommends products entirely in it.
     When the attribute permutation doesn't, will attempt to fill the rest of the recommendation with products products,
     dropping attribute requirements starting at the end one by one, until enough products to recommend are found.
     If this still doesn't result in enough products to recommend, will fill the rest of the recommendation with random products.
 
+    Works bottom-up on the flattened data (see flatten_grouped_data()) instead of recursing through every dict:
+    first every permutation gets its own products, then every level, starting at the deepest, tries to finish the incomplete ones
+    within the dict they're in.
+
     Args:
         data: the dict_in_dict stucture as provided by group_data_by_unique_identifiers()
-        original_dataset: the original PostgreSQL query result, to fetch random products from.
-        current_level: current level of recursion, should always be left on 0 on initial method call.
+        product_ids: list containing the ID of every product, to fetch random products from.
+            (only the first attribute of each product is recommended, so there's no need to carry the full query result around)
+        current_level: the level of data within the full dict_in_dict structure, should be left on 0 when passing the full structure.
         recommendation_amount: the amount of products that should be recommended per attribute permutation.
 
     Returns:
-        list containing lists for every recommendation. Every nested list contains:
-            A tuple for every product in the recommendation that contain:
-                All attributes for that product, formatted exactly as they were in the Psycopg2 query result."""
-    if isinstance(data, dict): #TODO: Add more comments
-        dataset, incomplete_indexes, current_index_in_dataset = [], [], 0
-        for k, v in data.items():#unpack every v one level deeper
-            result_from_one_layer_deeper, incomplete_data = content_filter_recommendations_from_grouped_data(v, original_dataset, current_level + 1)
-            incomplete_indexes += [x + current_index_in_dataset for x in incomplete_data]
-            for item in result_from_one_layer_deeper:
-                dataset.append(item)
-                current_index_in_dataset += 1
-        able_to_complete_datapoints = True
-        for index in incomplete_indexes: #try to finish all incomplete datapoints
-            if len(dataset) - len(incomplete_indexes) >= recommendation_amount: #Try to use incomplete_indexes to finish the incomplete datapoints
-                for i in range(len(dataset[index]), recommendation_amount):
-                    random_datapoint = random.choice(random.choice(dataset))
-                    dataset[index].append(random_datapoint)
-            elif current_level == 0: #Random additions from the original dataset
-                for i in range(len(dataset[index]), recommendation_amount):
-                    dataset[index].append(random.choice(original_dataset))
-            else:
-                able_to_complete_datapoints = False
+        tuple containing:
+            0: list containing a tuple for every recommendation. Every tuple contains:
+                0: tuple containing the keys of the attribute permutation (see flatten_grouped_data()).
+                1: list containing the IDs (first attribute in the Psycopg2 query result) of the recommended products.
+            1: list containing the indexes of the recommendations that could not be completed (only if current_level != 0)."""
+    with _garbage_collection_paused(): #only allocates lists and tuples that can't form reference cycles
+        flattened, node_ends = _flatten_grouped_data_with_node_ends(data)
+        dataset = [None] * len(flattened)
+        incomplete_indexes = []
+        for index, (keys, products) in enumerate(flattened):
+            if len(products) >= recommendation_amount * 8: #big enough to draw with replacement (cheaper), and only redraw on the rare duplicate
+                recommended_ids = [product[0] for product in random.choices(products, k=recommendation_amount)]
+                if len(set(recommended_ids)) < recommendation_amount:
+                    recommended_ids = [product[0] for product in random.sample(products, recommendation_amount)]
+            elif len(products) > recommendation_amount:
+                recommended_ids = [product[0] for product in random.sample(products, recommendation_amount)]
+            else: #every product gets recommended anyway, so there's nothing to draw
+                recommended_ids = [product[0] for product in products]
+            dataset[index] = keys, recommended_ids
+            if len(products) < recommendation_amount:
+                incomplete_indexes.append(index)
+        for level in range(len(node_ends) - 1, -1, -1): #deepest level first
+            if not incomplete_indexes: #nothing left to finish on this level or any above it
                 break
-        if able_to_complete_datapoints:
-            incomplete_indexes = []
-        return dataset, incomplete_indexes #change to index
-    else:
-        if len(data) < recommendation_amount:
-            return [random.sample(data, min(recommendation_amount, len(data)))], [0]
-        else:
-            return [random.sample(data, recommendation_amount)], []
+            ends, still_incomplete_indexes = node_ends[level], []
+            #incomplete_indexes is sorted, so the incomplete indexes of each dict on this level come in consecutive runs
+            for node, node_incomplete_indexes in itertools.groupby(incomplete_indexes, key=functools.partial(bisect.bisect_right, ends)):
+                node_start = ends[node - 1] if node else 0
+                node_product_lists = [products for _, products in flattened[node_start:ends[node]]]
+                still_incomplete_indexes += _finish_incomplete_recommendations(dataset, list(node_incomplete_indexes), node_product_lists, product_ids,
+                                                                               current_level + level == 0, recommendation_amount)
+            incomplete_indexes = still_incomplete_indexes
+        return dataset, incomplete_indexes
+
+
+_worker_data = None
+
+
+def _set_worker_data(data: dict):
+    """Pool initializer for parallel_content_filter_recommendations_from_grouped_data().
+    Stores the dict_in_dict structure in a module global of the worker process.
+
+    Args:
+        data: the dict_in_dict stucture as provided by group_data_by_unique_identifiers()"""
+    global _worker_data
+    _worker_data = data
+
+
+def _content_filter_worker(key, recommendation_amount: int) -> tuple[list, list]:
+    """Run content_filter_recommendations_from_grouped_data() on a single top level key of the worker's data.
 
+    Args:
+        key: the top level key (for instance a category) to generate recommendations for.
+        recommendation_amount: the amount of products that should be recommended per attribute permutation.
+
+    Returns:
+        the same as content_filter_recommendations_from_grouped_data()"""
+    return content_filter_recommendations_from_grouped_data(_worker_data[key], None, current_level=1, recommendation_amount=recommendation_amount)
 
-def content_filter_result_to_useful_SQL_dataset(data: list[list[tuple]]) -> list[tuple]:
-    """Generate a dataset that can be used for PostgresDAO.PostgreSQLdb.many_update_queries()
+
+def parallel_content_filter_recommendations_from_grouped_data(data: dict, product_ids: list, recommendation_amount: int = 4, processes: int = None) -> tuple[list, list]:
+    """Does the same as content_filter_recommendations_from_grouped_data() on the full dict_in_dict structure,
+    but handles every top level key (for instance every category) in a separate process, as they're independent of eachother.
+    Only the recommendations that are still incomplete after that are finished in the main process.
+
+    NOTE: Like any use of multiprocessing, only call this from within an 'if __name__ == "__main__":' block.
+    NOTE: The work per top level key is only a few random draws, so this only pays off on machines with several cores
+    and large datasets. With the 'spawn' start method (the default on Windows and macOS) or 'forkserver',
+    the full dict_in_dict structure gets pickled to every worker process first.
+    Measure against content_filter_recommendations_from_grouped_data() before using it.
+
+    Args:
+        data: the dict_in_dict stucture as provided by group_data_by_unique_identifiers()
+        product_ids: list containing the ID of every product, to fetch random products from.
+        recommendation_amount: the amount of products that should be recommended per attribute permutation.
+        processes: the amount of worker processes to use, defaults to the amount of CPU cores.
+
+    Returns:
+        the same as content_filter_recommendations_from_grouped_data()"""
+    #the workers get data once through the initializer, and the tasks and results are only keys and ID lists.
+    #the initializer arguments are inherited without pickling with 'fork', but pickled once per worker with 'spawn'/'forkserver'.
+    #product_ids is only needed at the top level, so it isn't sent to the workers at all.
+    worker = functools.partial(_content_filter_worker, recommendation_amount=recommendation_amount)
+    with multiprocessing.Pool(processes, initializer=_set_worker_data, initargs=(data,)) as pool:
+        parts = pool.map(worker, data.keys())
+    dataset, incomplete_indexes = [], []
+    for key, (part_dataset, part_incomplete_indexes) in zip(data.keys(), parts):
+        incomplete_indexes += [index + len(dataset) for index in part_incomplete_indexes]
+        dataset += [((key, *keys), recommended_ids) for keys, recommended_ids in part_dataset]
+    if incomplete_indexes:
+        node_product_lists = [products for _, products in flatten_grouped_data(data)]
+        _finish_incomplete_recommendations(dataset, incomplete_indexes, node_product_lists, product_ids, True, recommendation_amount)
+    return dataset, []
+
+
+def content_filter_result_to_useful_SQL_dataset(data: tuple[list, list]) -> list[tuple]:
+    """Generate the rows to fill a recommendation table with through create_rcmd_table()
     out of the recommendation dataset as gained by content_filter_recommendations_from_grouped_data().
 
     Args:
         data: The recommendation dataset as gained by content_filter_recommendations_from_grouped_data()
-            -Assumes the product ID is the first attribute, and the attributes following that are the attributes to recommend based on.
 
     Returns:
-        Dataset that can be used for PostgresDAO.PostgreSQLdb.many_update_queries()"""
-    for recommendation in data[0]:
-        result_data = []
-        print(f"Recommendation: {recommendation}")
-        for unique_attribute in recommendation[0][1:]:
-            result_data.append(unique_attribute)
-        for product in recommendation:
-            result_data.append(product[0])
-
+        list containing a tuple for every recommendation, formatted as (*permutation keys, rcmd_1 ... rcmd_n),
+        where the rcmd's are the IDs of the recommended products."""
+    results = []
+    for keys, recommended_ids in data[0]:
+        results.append((*keys, *recommended_ids))
+    return results
 
-products = PostgresDAO.db.query("SELECT id, category, brand FROM products;", expect_return=True)
-grouped = group_data_by_unique_identifiers(products, [1, 2])
-recommendations = content_filter_recommendations_from_grouped_data(grouped, products)
-dataset = content_filter_result_to_useful_SQL_dataset(recommendations)
 
-create_rcmd_table(PostgresDAO.db, "Content_filtered", [("Category", "VARCHAR"), ("Brand", "VARCHAR")])
-query = construct_insert_query("Content_filtered", ["Category", "Brand"])
+if __name__ == "__main__":
+    product_ids, grouped = cached_group_query_result(PostgresDAO.db, "SELECT id, category, brand FROM products;",
+                                                     "SELECT COUNT(*), SUM(hashtextextended(p::text, 0)) FROM (SELECT id, category, brand FROM products) p;",
+                                                     [1, 2])
+    recommendations = content_filter_recommendations_from_grouped_data(grouped, product_ids)
+    dataset = content_filter_result_to_useful_SQL_dataset(recommendations)
 
-PostgresDAO.db.many_update_queries(query, dataset)
\ No newline at end of file
+    create_rcmd_table(PostgresDAO.db, "Content_filtered", [("Category", "VARCHAR"), ("Brand", "VARCHAR")], dataset)